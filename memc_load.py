@@ -1,28 +1,56 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import collections
 import glob
 import gzip
 import logging
+import mmap
 import os
+import struct
 import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from multiprocessing import Process
+from multiprocessing.connection import wait as wait_processes
 from optparse import OptionParser
-from queue import Queue
-from threading import Thread
 
-# pip install python-memcached
-import memcache
+try:
+    # pip install isal
+    from isal import isal_zlib as zlib
+except ImportError:
+    import zlib
+
+try:
+    # pip install rapidgzip
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+
+# pip install pymemcache
+from pymemcache.client.base import Client
+from pymemcache.exceptions import MemcacheClientError, MemcacheError
 
 # brew install protobuf
 # protoc  --python_out=. ./appsinstalled.proto
 # pip install protobuf
 import appsinstalled_pb2
+from google.protobuf.internal import api_implementation
 
 NORMAL_ERR_RATE = 0.01
 MEMC_SOCKET_TIMEOUT = 10
-MEMC_BATCH_SIZE = 100
-AppsInstalled = collections.namedtuple("AppsInstalled", ["dev_type", "dev_id", "lat", "lon", "apps"])
+MEMC_CONNECT_TIMEOUT = 5
+MEMC_MAX_RETRIES = 3
+MEMC_RETRY_DELAY = 0.1
+MEMC_BATCH_SIZE = 500
+MEMC_MAX_KEY_LENGTH = 250
+MEMC_PENDING_BATCHES_PER_WORKER = 2
+READ_CHUNK_SIZE = 1024 * 1024
+PARALLEL_GZIP_MIN_SIZE = 64 * 1024 * 1024
+USER_APPS_GEO = struct.Struct("<BdBd")
+DEVICES = ('idfa', 'gaid', 'adid', 'dvid')
+DEVICE_INDEX = {device.encode(): i for i, device in enumerate(DEVICES)}
+memc_clients = threading.local()
 
 
 def dot_rename(path):
@@ -31,131 +59,271 @@ def dot_rename(path):
     os.rename(path, os.path.join(head, "." + fn))
 
 
-def insert_apps_installed(memc_addr, queue, errors, dry_run=False):
+def decompress_gzip(fn):
+    if os.path.getsize(fn) == 0:
+        return
+    with open(fn, 'rb') as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        decompressor = None
+        pos = 0
+        while pos < len(mm):
+            data = mm[pos:pos + READ_CHUNK_SIZE]
+            pos += len(data)
+            while data:
+                if decompressor is None:
+                    # file may contain several concatenated gzip members, padded with zeros
+                    data = data.lstrip(b"\0")
+                    if not data:
+                        break
+                    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                chunk = decompressor.decompress(data, READ_CHUNK_SIZE)
+                if chunk:
+                    yield chunk
+                if decompressor.eof:
+                    data = decompressor.unused_data
+                    decompressor = None
+                else:
+                    data = decompressor.unconsumed_tail
+        if decompressor is not None:
+            chunk = decompressor.flush()
+            if chunk:
+                yield chunk
+            if not decompressor.eof:
+                raise EOFError("Compressed file ended before the end-of-stream marker was reached: %s" % fn)
+
+
+def read_chunks(fn, parallelization=1):
+    if rapidgzip is None or os.path.getsize(fn) < PARALLEL_GZIP_MIN_SIZE:
+        yield from decompress_gzip(fn)
+        return
+    with open(fn, 'rb') as fd:
+        fd.seek(-4, os.SEEK_END)
+        trailer = fd.read(4)
+    if trailer.endswith(b"\0"):
+        # rapidgzip rejects zero padding after the last member
+        yield from decompress_gzip(fn)
+        return
+    # On damaged input rapidgzip may stop early without an error, raise RuntimeError or even abort
+    # the interpreter; the last two fail the loader process, so the file is never renamed.
+    size = 0
+    with rapidgzip.open(fn, parallelization=parallelization) as fd:
+        while True:
+            chunk = fd.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            yield chunk
+    # ISIZE only covers the last member, so a mismatch is rechecked by decompressing the whole file
+    isize, = struct.unpack("<I", trailer)
+    if size & 0xFFFFFFFF != isize:
+        for _ in decompress_gzip(fn):
+            pass
+
+
+def iter_lines(chunks):
+    tail = b""
+    for chunk in chunks:
+        lines = (tail + chunk).split(b"\n")
+        tail = lines.pop()
+        yield from lines
+    if tail:
+        yield tail
+
+
+def get_memc_client(memc_addr):
+    clients = getattr(memc_clients, 'by_addr', None)
+    if clients is None:
+        clients = memc_clients.by_addr = dict()
+    if memc_addr not in clients:
+        clients[memc_addr] = Client(memc_addr, no_delay=True, connect_timeout=MEMC_CONNECT_TIMEOUT,
+                                    timeout=MEMC_SOCKET_TIMEOUT)
+    return clients[memc_addr]
+
+
+def memc_set_multi(memc_client, memc_addr, keys):
+    for attempt in range(MEMC_MAX_RETRIES + 1):
+        try:
+            key_errors = memc_client.set_many(keys, noreply=True)
+            break
+        except MemcacheClientError as e:
+            # rejected before anything was sent, retrying will not help
+            logging.error("Cannot write %s keys to memcache %s: %s", len(keys), memc_addr, e)
+            return len(keys)
+        except (MemcacheError, OSError) as e:
+            memc_client.close()
+            if attempt == MEMC_MAX_RETRIES:
+                logging.error("Cannot write %s keys to memcache %s: %s", len(keys), memc_addr, e)
+                return len(keys)
+            time.sleep(MEMC_RETRY_DELAY * 2 ** attempt)
+    if key_errors:
+        logging.error("Get error when write to memcache %s. Failed keys: %s", memc_addr,
+                      b",".join(key_errors).decode(errors="replace"))
+    return len(key_errors)
+
+
+def insert_batch(memc_addr, keys, dry_run=False):
+    if dry_run:
+        ua = appsinstalled_pb2.UserApps()
+        for key, packed in keys.items():
+            ua.ParseFromString(packed)
+            logging.debug("%s - %s -> %s", memc_addr, key.decode(errors="replace"), str(ua).replace("\n", " "))
+        return 0
+    return memc_set_multi(get_memc_client(memc_addr), memc_addr, keys)
+
+
+def submit_batch(executor, slots, memc_addr, keys, dry_run=False):
+    # blocks the reader while too many batches are waiting for a worker
+    slots.acquire()
+    future = executor.submit(insert_batch, memc_addr, keys, dry_run)
+    future.add_done_callback(lambda _: slots.release())
+    return future
+
+
+def pack_user_apps(lat, lon, apps):
+    # UserApps wire format: each app as field 1 varint, then lat and lon as fields 2 and 3 doubles
+    buf = bytearray()
+    for app in apps:
+        if not 0 <= app <= 0xFFFFFFFF:
+            raise ValueError("Value out of range: %d" % app)
+        buf.append(0x08)
+        while app > 0x7F:
+            buf.append(app & 0x7F | 0x80)
+            app >>= 7
+        buf.append(app)
+    buf += USER_APPS_GEO.pack(0x11, lat, 0x19, lon)
+    return bytes(buf)
+
+
+def pack_user_apps_pb2(lat, lon, apps):
     ua = appsinstalled_pb2.UserApps()
-    memc_client = memcache.Client([memc_addr], socket_timeout=MEMC_SOCKET_TIMEOUT)
-
-    keys = dict()
-    while True:
-        apps_installed = queue.get()
-        if not apps_installed:
-            if keys:
-                key_errors = memc_client.set_multi(keys)
-                if key_errors:
-                    logging.error(f'Get error when write to memcache {memc_addr}. Failed keys: {",".join(key_errors)}')
-                    errors.put(len(key_errors))
-            return
-        ua.lat = apps_installed.lat
-        ua.lon = apps_installed.lon
-        key = "%s:%s" % (apps_installed.dev_type, apps_installed.dev_id)
-        ua.apps.extend(apps_installed.apps)
-        packed = ua.SerializeToString()
-        if dry_run:
-            logging.debug("%s - %s -> %s" % (memc_addr, key, str(ua).replace("\n", " ")))
-            continue
-        if len(keys) < MEMC_BATCH_SIZE:
-            keys[key] = packed
-        else:
-            key_errors = memc_client.set_multi(keys)
-            keys.clear()
-            if key_errors:
-                logging.error(f'Get error when write to memcache {memc_addr}. Failed keys: {",".join(key_errors)}')
-                errors.put(len(key_errors))
+    ua.lat = lat
+    ua.lon = lon
+    ua.apps.extend(apps)
+    return ua.SerializeToString()
 
 
-def parse_apps_installed(line):
-    line_parts = line.decode().strip().split("\t")
-    if len(line_parts) < 5:
+def parse_and_pack(line, pack):
+    line_parts = line.split(b"\t")
+    if len(line_parts) != 5:
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("Invalid line: `%s`", line.decode(errors="replace"))
         return
     dev_type, dev_id, lat, lon, raw_apps = line_parts
     if not dev_type or not dev_id:
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("Invalid line: `%s`", line.decode(errors="replace"))
+        return
+    device_index = DEVICE_INDEX.get(dev_type, -1)
+    if device_index < 0:
+        logging.error("Unknown device type: %s", dev_type.decode(errors="replace"))
+        return
+    key = b"%s:%s" % (dev_type, dev_id)
+    if len(key) > MEMC_MAX_KEY_LENGTH or key.split() != [key] or b"\0" in key:
+        logging.info("Invalid memcache key: `%s`", line.decode(errors="replace"))
         return
     try:
-        apps = [int(a.strip()) for a in raw_apps.split(",")]
+        apps = [int(a) for a in raw_apps.split(b",")]
     except ValueError:
-        apps = [int(a.strip()) for a in raw_apps.split(",") if a.isidigit()]
-        logging.info("Not all user apps are digits: `%s`" % line)
+        apps = [int(a) for a in raw_apps.split(b",") if a.strip().isdigit()]
+        logging.info("Not all user apps are digits: `%s`", line.decode(errors="replace"))
     try:
         lat, lon = float(lat), float(lon)
     except ValueError:
-        logging.info("Invalid geo coords: `%s`" % line)
-    return AppsInstalled(dev_type, dev_id, lat, lon, apps)
-
-
-def process_line(line, device_memc, errors):
-    apps_installed = parse_apps_installed(line)
-    if not apps_installed:
-        logging.info('apps_installed is None')
-        errors.put(1)
+        logging.info("Invalid geo coords: `%s`", line.decode(errors="replace"))
         return
-    queue = device_memc.get(apps_installed.dev_type)
-    if not queue:
-        logging.error("Unknown device type: %s" % apps_installed.dev_type)
-        errors.put(1)
+    try:
+        packed = pack(lat, lon, apps)
+    except ValueError:
+        logging.info("User apps out of range: `%s`", line.decode(errors="replace"))
         return
-    queue.put(apps_installed)
+    return device_index, key, packed
 
 
 def process_file(fn, options):
     logging_configure(options)
-    devices = ['idfa', 'gaid', 'adid', 'dvid']
     total = 0
-    errors_queue = Queue()
-    inserters = []
-
-    inserts_by_device_count = int(int(options.workers) / len(devices))
-    device_memc = dict()
-    for device in devices:
-        queue = Queue()
-        device_memc[device] = queue
-        for _ in range(inserts_by_device_count):
-            i = Thread(target=insert_apps_installed, args=(getattr(options, device), queue, errors_queue, options.dry))
-            i.start()
-            inserters.append(i)
-
-    logging.info('Processing %s' % fn)
-    logging.info(f'Threads for inserts app to memcache by devive: {inserts_by_device_count}')
-    fd = gzip.open(fn)
-
-    for line in fd:
+    errors = 0
+    pack = pack_user_apps_pb2 if options.pb2 else pack_user_apps
+
+    workers = int(options.workers)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    slots = threading.BoundedSemaphore(workers * MEMC_PENDING_BATCHES_PER_WORKER)
+    inserts = []
+    device_memc = [getattr(options, device) for device in DEVICES]
+    device_batches = [dict() for _ in DEVICES]
+
+    logging.info('Processing %s', fn)
+    logging.info('Threads for inserts app to memcache: %s', workers)
+    parallelization = max(1, os.cpu_count() // int(options.processes))
+    for line in iter_lines(read_chunks(fn, parallelization)):
         line = line.strip()
         if not line:
             continue
         total += 1
         if total > 1000 and total % 1000 == 0:
-            logging.info(f'Read {total} lines from {fn}')
-        process_line(line, device_memc, errors_queue)
+            logging.info('Read %s lines from %s', total, fn)
+        record = parse_and_pack(line, pack)
+        if record is None:
+            errors += 1
+            continue
+        device_index, key, packed = record
+        batch = device_batches[device_index]
+        batch[key] = packed
+        if len(batch) >= MEMC_BATCH_SIZE:
+            inserts.append(submit_batch(executor, slots, device_memc[device_index], batch, options.dry))
+            device_batches[device_index] = dict()
 
-    for queue in device_memc.values():
-        for _ in range(inserts_by_device_count):
-            queue.put(None)
-    logging.info(f'Wait while all apps from {fn} inserted')
-    for i in inserters:
-        i.join()
+    for memc_addr, batch in zip(device_memc, device_batches):
+        if batch:
+            inserts.append(submit_batch(executor, slots, memc_addr, batch, options.dry))
+    logging.info('Wait while all apps from %s inserted', fn)
+    wait(inserts)
+    executor.shutdown()
 
-    errors = 0
-    while not errors_queue.empty():
-        errors += errors_queue.get()
+    errors += sum(f.result() for f in inserts)
 
-    logging.info(f'Parsed {total} lines')
-    logging.info(f'Found {errors} errors')
-    err_rate = float(errors) / total
+    logging.info('Parsed %s lines', total)
+    logging.info('Found %s errors', errors)
+    err_rate = float(errors) / total if total else 0.0
     if err_rate < NORMAL_ERR_RATE:
-        logging.info("Acceptable error rate (%s). Successful load" % err_rate)
+        logging.info("Acceptable error rate (%s). Successful load", err_rate)
     else:
-        logging.error("High error rate (%s > %s). Failed load" % (err_rate, NORMAL_ERR_RATE))
-    fd.close()
+        logging.error("High error rate (%s > %s). Failed load", err_rate, NORMAL_ERR_RATE)
     dot_rename(fn)
 
 
+def load_file(fn, options):
+    try:
+        process_file(fn, options)
+    except Exception:
+        logging.exception("Failed to process %s", fn)
+        sys.exit(1)
+
+
+def join_finished(loaders):
+    # a loader killed by a signal (abort, OOM, segfault) only shows up in its exit code
+    failed = 0
+    for sentinel in wait_processes(list(loaders)):
+        fn, p = loaders.pop(sentinel)
+        p.join()
+        if p.exitcode != 0:
+            logging.error("Loader for %s exited with code %s", fn, p.exitcode)
+            failed += 1
+    return failed
+
+
 def main(options):
-    file_handlers = list()
+    loaders = dict()
+    failed = 0
     for fn in glob.iglob(options.pattern):
-        p = Process(target=process_file, args=(fn, options))
+        while len(loaders) >= int(options.processes):
+            failed += join_finished(loaders)
+        p = Process(target=load_file, args=(fn, options))
         p.start()
-        file_handlers.append(p)
-    for p in file_handlers:
-        p.join()
+        loaders[p.sentinel] = (fn, p)
+    while loaders:
+        failed += join_finished(loaders)
+    if failed:
+        logging.error("Failed to process %s files", failed)
 
 
 def proto_test():
@@ -172,6 +340,28 @@ def proto_test():
         unpacked = appsinstalled_pb2.UserApps()
         unpacked.ParseFromString(packed)
         assert ua == unpacked
+        assert pack_user_apps(lat, lon, apps) == packed
+        assert parse_and_pack(line.encode(), pack_user_apps)[2] == packed
+
+    assert list(iter_lines([b"ab", b"c\nd", b"e\n", b"f"])) == [b"abc", b"de", b"f"]
+    big = b"x\n" * READ_CHUNK_SIZE
+    members = gzip.compress(b"a\nb\n") + gzip.compress(big) + b"\0" * 16 + gzip.compress(b"c\n") + b"\0" * 8
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = os.path.join(tmp, "sample.tsv.gz")
+        for data, expected in ((b"", b""), (members, b"a\nb\n" + big + b"c\n")):
+            with open(fn, "wb") as fd:
+                fd.write(data)
+            chunks = list(decompress_gzip(fn))
+            assert b"".join(chunks) == expected
+            assert all(len(chunk) <= READ_CHUNK_SIZE for chunk in chunks)
+        with open(fn, "wb") as fd:
+            fd.write(gzip.compress(b"a\nb\n") + gzip.compress(big)[:-4])
+        try:
+            list(decompress_gzip(fn))
+        except EOFError:
+            pass
+        else:
+            raise AssertionError("truncated gzip was accepted")
 
 
 def logging_configure(opts):
@@ -184,7 +374,9 @@ if __name__ == '__main__':
     op.add_option("-t", "--test", action="store_true", default=False)
     op.add_option("-l", "--log", action="store", default=None)
     op.add_option("-w", "--workers", action="store", default=40)
+    op.add_option("-p", "--processes", action="store", default=os.cpu_count())
     op.add_option("--dry", action="store_true", default=False)
+    op.add_option("--pb2", action="store_true", default=False)
     op.add_option("--pattern", action="store", default="/data/appsinstalled/*.tsv.gz")
     op.add_option("--idfa", action="store", default="127.0.0.1:33013")
     op.add_option("--gaid", action="store", default="127.0.0.1:33014")
@@ -195,10 +387,12 @@ if __name__ == '__main__':
     if opts.test:
         proto_test()
         sys.exit(0)
+    if opts.pb2 and api_implementation.Type() not in ('upb', 'cpp'):
+        logging.warning("Slow protobuf backend in use: %s", api_implementation.Type())
 
-    logging.info("Memc loader started with options: %s" % opts)
+    logging.info("Memc loader started with options: %s", opts)
     try:
         main(opts)
     except Exception as e:
-        logging.exception("Unexpected error: %s" % e)
+        logging.exception("Unexpected error: %s", e)
         sys.exit(1)